@@ -23,7 +23,8 @@ wanted_text = st.text_area(
     height=140
 )
 
-wait_seconds = st.number_input("Attesa dopo click variante (secondi)", min_value=0, max_value=60, value=15, step=1)
+wait_seconds = st.number_input("Attesa massima dopo click variante (secondi)", min_value=0, max_value=60, value=15, step=1)
+parallel_pages = st.number_input("Tab in parallelo per le varianti", min_value=1, max_value=6, value=3, step=1)
 
 col1, col2 = st.columns([1, 1])
 with col1:
@@ -59,6 +60,7 @@ if st.button("Scarica ZIP immagini", use_container_width=True, type="primary"):
                 wanted_colors=wanted_colors,
                 wait_after_click_seconds=int(wait_seconds),
                 headless=headless,
+                parallel_pages=int(parallel_pages),
             )
         except Exception as e:
             st.error(f"Errore: {type(e).__name__}: {e}")
@@ -69,9 +71,14 @@ if st.button("Scarica ZIP immagini", use_container_width=True, type="primary"):
         f"immagini scaricate: {len(result.downloaded_ok)} — fallite: {len(result.downloaded_failed)}"
     )
 
+    # download_button vuole tutti i bytes in memoria: su questo percorso lo spill
+    # su disco oltre 64 MiB non limita la RAM. Il file temporaneo si chiude subito.
+    zip_data = result.zip_bytes
+    result.zip_file.close()
+
     st.download_button(
         "Download ZIP",
-        data=result.zip_bytes,
+        data=zip_data,
         file_name="immagini.zip",
         mime="application/zip",
         use_container_width=True,
@@ -1,18 +1,95 @@
+import atexit
+import functools
+import hashlib
+import hmac
 import io
+import json
 import os
 import re
+import secrets
+import shutil
+import tempfile
+import threading
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple
 from urllib.parse import urljoin, urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 
 # Evita che Playwright provi a scaricare browser (su Streamlit Cloud spesso fallisce)
 os.environ.setdefault("PLAYWRIGHT_SKIP_BROWSER_DOWNLOAD", "1")
 
+# Download immagini in parallelo: il collo di bottiglia è la latenza di rete, non la CPU
+DOWNLOAD_WORKERS = 8
+
+# Archivi più grandi di così vengono scritti su disco invece che tenuti in RAM
+ZIP_SPOOL_MAX_BYTES = 64 * 1024 * 1024
+# Body di una singola immagine: in RAM fino a questa soglia, oltre su file temporaneo
+BODY_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+# Foto principale della gallery (l'unica che scarichiamo per ogni variante)
+MAIN_PHOTO_SEL = "#js_productMainPhoto img.callToZoom"
+
+# Swatch colore cliccabili
+SWATCH_SEL = "a.js_colorswitch.colorSwitch"
+
+# Link che apre il popup di login (assente quando la sessione è già autenticata)
+LOGIN_TRIGGER_SEL = "a.login.js_popupLogin"
+
+# Sessione Playwright (cookie) salvata su disco per credenziali: oltre questa età si rifà il login
+LOGIN_STATE_MAX_AGE_S = 6 * 3600
+# Chiave HMAC del nome file: casuale per processo, come la cartella privata che
+# contiene i file (la cache vale finché gira il server, poi si rifà il login)
+_LOGIN_STATE_SECRET = secrets.token_bytes(32)
+_login_state_dir: Optional[str] = None
+_login_state_dir_lock = threading.Lock()
+
+# Risorse inutili per leggere swatch e foto: bloccarle accorcia ogni navigazione.
+# Wildcard di Network.setBlockedURLs (CDP): font, video e script di analytics
+_BLOCKED_URL_PATTERNS = (
+    "*.woff*", "*.ttf*", "*.otf*", "*.eot*",
+    "*.mp4*", "*.webm*",
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*connect.facebook.net*",
+)
+
+# Regex compilate una volta sola (usate per ogni variante / ogni URL)
+_IMG_EXT_RE = re.compile(r"\.(jpg|jpeg|png|webp|gif)(\?|$)", re.I)  # estensione per il nome nello ZIP
+_WS_RE = re.compile(r"\s+")
+_UNSAFE_FILENAME_RE = re.compile(r"[^\w\-.]+")
+_OPT_SIZE_PREFIX_RE = re.compile(r"/opt-\d+x\d+-")   # /media/.../opt-490x735-rj265m.jpg
+_SIZE_PREFIX_RE = re.compile(r"/\d+x\d+-")           # thumb tipo /113x40-...
+
+# Le immagini sono già compresse: chiediamo il body così com'è (niente gzip HTTP),
+# così r.raw si copia nello ZIP senza passare dal decoder di urllib3
+_IMAGE_REQUEST_HEADERS = {"Accept-Encoding": "identity"}
+
+# Header fissi della sessione di download (il Referer è il prodotto di ogni run)
+_DOWNLOAD_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; ImageDownloader/1.0)",
+    "Accept": "*/*",
+}
+
+# Content-Type generici con cui alcuni CDN servono comunque immagini
+_GENERIC_BINARY_TYPES = ("application/octet-stream", "binary/octet-stream")
+
+# Formati già compressi: nello ZIP vanno STORED, deflate non guadagnerebbe nulla
+_PRECOMPRESSED_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif")
+
+# Content-Type -> estensione del file nello ZIP
+_CT_EXT = {
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+
 
 # -----------------------
 # Helpers
@@ -26,15 +103,59 @@ def _is_http_url(u: str) -> bool:
         return False
 
 
+# Chiamata più volte sugli stessi titoli/codici swatch: input brevi, cache minima
+@functools.lru_cache(maxsize=512)
 def _norm(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "").strip().lower())
+    return _WS_RE.sub(" ", (s or "").strip().lower())
 
 
 def _clean_filename(name: str) -> str:
-    name = re.sub(r"[^\w\-.]+", "_", name.strip())
+    name = _UNSAFE_FILENAME_RE.sub("_", name.strip())
     return name[:180] if name else "file"
 
 
+def _private_state_dir() -> str:
+    # mkdtemp crea la cartella con permessi 0700: nome non prevedibile, leggibile solo da noi
+    global _login_state_dir
+    with _login_state_dir_lock:
+        if _login_state_dir is None:
+            _login_state_dir = tempfile.mkdtemp(prefix="iw_state_")
+            atexit.register(shutil.rmtree, _login_state_dir, ignore_errors=True)
+        return _login_state_dir
+
+
+def _login_state_path(email: str, password: str) -> str:
+    # Email e password entrambe nella chiave: con una password diversa il file
+    # non si trova e si rifà il login, invece di riusare la sessione di altri
+    msg = f"{_norm(email)}\0{password or ''}".encode("utf-8")
+    digest = hmac.new(_LOGIN_STATE_SECRET, msg, hashlib.sha256).hexdigest()
+    return os.path.join(_private_state_dir(), f"{digest}.json")
+
+
+def _save_login_state(context, path: str) -> None:
+    # mkstemp apre già con 0600; os.replace rende visibile solo il file completo
+    state = context.storage_state()
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _fresh_login_state(path: str) -> Optional[str]:
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+    return path if age < LOGIN_STATE_MAX_AGE_S else None
+
+
 def _guess_chromium_executable() -> Optional[str]:
     # Percorsi tipici in container Debian
     candidates = [
@@ -50,90 +171,312 @@ def _guess_chromium_executable() -> Optional[str]:
     return None
 
 
-def _best_image_url_candidates(img_url: str) -> List[str]:
+@functools.lru_cache(maxsize=1024)
+def _best_image_url_candidates(img_url: str) -> Tuple[str, ...]:
     """
     Dal tuo esempio:
       /media/.../opt-490x735-rj265m.jpg
     spesso esiste anche:
       /media/.../rj265m.jpg  (originale, più grande)
     Quindi: proviamo prima "senza opt-WxH-", poi fallback.
+    Memoizzata (stesse foto tra run della stessa sessione): ritorna una tupla.
     """
     if not img_url:
-        return []
+        return ()
 
     cands = [img_url]
 
     # rimuove "opt-123x456-" se presente
-    c2 = re.sub(r"/opt-\d+x\d+-", "/", img_url)
+    c2 = _OPT_SIZE_PREFIX_RE.sub("/", img_url)
     if c2 != img_url:
         cands.insert(0, c2)
 
     # se ci sono thumb tipo 113x40-..., prova a rimuovere anche quello
-    c3 = re.sub(r"/\d+x\d+-", "/", img_url)
+    c3 = _SIZE_PREFIX_RE.sub("/", img_url)
     if c3 not in cands:
         cands.insert(0, c3)
 
     # unisci e dedup preservando ordine
-    out = []
-    seen = set()
-    for u in cands:
-        if u not in seen:
-            seen.add(u)
-            out.append(u)
-    return out
+    return tuple(dict.fromkeys(cands))
 
 
-def _pick_best_existing_url(session: requests.Session, candidates: List[str]) -> str:
+def _probe_cache_key(candidates: Sequence[str]) -> Tuple[str, int, bool]:
+    # Stesso host + stessa "forma" dell'URL (numero di riscritture, prefisso opt-)
+    # => su questo sito vince la stessa riscrittura per tutte le varianti
+    p = urlparse(candidates[-1])
+    return p.netloc, len(candidates), "/opt-" in p.path
+
+
+class _ProbeCache:
     """
-    Prova HEAD/GET leggero per capire quale URL esiste davvero.
-    Se HEAD non è permesso, ripiega su GET con stream=True.
+    Riscrittura hi-res vincente (indice nella lista candidati) per forma di URL.
+    Condivisa tra i thread del pool: il lock fa sì che la prima variante faccia
+    i probe e le altre, in attesa, trovino già la regola.
     """
-    for u in candidates:
-        try:
-            r = session.head(u, timeout=15, allow_redirects=True)
-            if r.status_code == 200:
-                return u
-        except Exception:
-            pass
 
-    for u in candidates:
+    def __init__(self) -> None:
+        self.rules: Dict[Tuple[str, int, bool], int] = {}
+        self.lock = threading.Lock()
+
+
+def _non_image_type(r: requests.Response) -> str:
+    # Content-Type dichiarato che non è un'immagine (pagina HTML di errore, soft-404,
+    # login scaduto...): lo ritorna, "" se la response può essere un'immagine
+    ct = r.headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if ct and not ct.startswith("image/") and ct not in _GENERIC_BINARY_TYPES:
+        return ct
+    return ""
+
+
+def _probe_existing_index(session: requests.Session, candidates: Sequence[str]) -> Optional[int]:
+    # GET con Range: bytes=0-0 -> 206 in un solo round-trip e senza body;
+    # a differenza di HEAD non viene rifiutato (405) dai CDN
+    for i, u in enumerate(candidates):
         try:
-            r = session.get(u, timeout=20, stream=True, allow_redirects=True)
-            if r.status_code == 200:
-                return u
+            r = session.get(
+                u,
+                headers={"Range": "bytes=0-0", **_IMAGE_REQUEST_HEADERS},
+                timeout=10,
+                stream=True,
+                allow_redirects=True,
+            )
+            r.close()
+            # un 200 HTML (soft-404) non conta: si passa al candidato successivo
+            if r.status_code in (200, 206) and not _non_image_type(r):
+                return i
         except Exception:
             pass
 
-    return candidates[-1] if candidates else ""
+    return None
+
+
+def _pick_best_existing_url(
+    session: requests.Session,
+    candidates: Sequence[str],
+    probe_cache: Optional[_ProbeCache] = None,
+) -> str:
+    """
+    Prova un GET leggero (Range: bytes=0-0) per capire quale URL esiste davvero.
+    Con `probe_cache` la riscrittura vincente viene imparata alla prima variante
+    e riusata per le altre senza nuovi probe.
+    """
+    if not candidates:
+        return ""
+    if len(candidates) == 1:
+        # URL senza prefissi opt-WxH-/WxH-: nessuna alternativa da verificare
+        return candidates[0]
+
+    if probe_cache is None:
+        i = _probe_existing_index(session, candidates)
+        return candidates[-1] if i is None else candidates[i]
+
+    key = _probe_cache_key(candidates)
+    with probe_cache.lock:
+        if key not in probe_cache.rules:
+            i = _probe_existing_index(session, candidates)
+            if i is None:
+                return candidates[-1]
+            probe_cache.rules[key] = i
+        return candidates[probe_cache.rules[key]]
 
 
-def _download_bytes(session: requests.Session, url: str) -> Tuple[Optional[bytes], str]:
+def _cookie_jar_from_playwright(cookies) -> requests.cookies.RequestsCookieJar:
+    """
+    Jar costruito in un solo passaggio dai cookie di Playwright e assegnato
+    in blocco alla sessione (dominio, path, secure e scadenza preservati).
+    """
+    jar = requests.cookies.RequestsCookieJar()
+    for c in cookies:
+        expires = c.get("expires", -1)
+        jar.set_cookie(requests.cookies.create_cookie(
+            name=c["name"],
+            value=c["value"],
+            domain=c.get("domain", ""),
+            path=c.get("path", "/"),
+            secure=bool(c.get("secure")),
+            expires=int(expires) if expires and expires > 0 else None,
+        ))
+    return jar
+
+
+def _build_download_session(product_url: str, cookies, download_workers: int) -> requests.Session:
+    sess = requests.Session()
+    sess.headers.update(_DOWNLOAD_HEADERS)
+    sess.headers["Referer"] = product_url
+    # Pool keep-alive mai più piccolo dei worker: lo stesso host viene colpito molte
+    # volte, così TCP+TLS si pagano una volta sola per connessione
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=max(32, int(download_workers)),
+        pool_block=False,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False,
+        ),
+    )
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    sess.cookies = _cookie_jar_from_playwright(cookies)
+    return sess
+
+
+def _open_image_stream(session: requests.Session, url: str) -> Tuple[Optional[requests.Response], str]:
+    """
+    GET in streaming: ritorna la response con il body ancora da leggere,
+    così i bytes passano dal socket al buffer del worker senza un `bytes` intero in memoria.
+    """
     try:
-        r = session.get(url, timeout=40, allow_redirects=True)
-        if r.status_code != 200 or not r.content:
-            return None, f"HTTP {r.status_code}"
-        return r.content, ""
+        r = session.get(url, headers=_IMAGE_REQUEST_HEADERS, timeout=40, allow_redirects=True, stream=True)
     except Exception as e:
         return None, type(e).__name__
 
+    if r.status_code != 200 or r.headers.get("Content-Length") == "0":
+        r.close()
+        return None, f"HTTP {r.status_code}"
+
+    # Status e header arrivano prima del body: una pagina HTML (errore, login
+    # scaduto...) si scarta subito, senza scaricarla
+    ct = _non_image_type(r)
+    if ct:
+        r.close()
+        return None, f"not an image ({ct})"
+    return r, ""
+
+
+def _fetch_best_image(
+    session: requests.Session,
+    main_url: str,
+    probe_cache: _ProbeCache,
+) -> Tuple[str, Optional[requests.Response], str]:
+    """
+    Sceglie la versione hi-res e apre il download (body ancora da leggere).
+    """
+    cands = _best_image_url_candidates(main_url)
+    best = _pick_best_existing_url(session, cands, probe_cache)
+    resp, err = _open_image_stream(session, best)
+    if resp is None and len(cands) > 1:
+        # La regola imparata può non valere per questa variante: probe completo
+        retry = _pick_best_existing_url(session, cands)
+        if retry != best:
+            best = retry
+            resp, err = _open_image_stream(session, best)
+    return best, resp, err
+
+
+def _image_extension(url: str, content_type: str) -> str:
+    # Prima il Content-Type (lookup diretto), poi l'estensione nell'URL
+    ext = _CT_EXT.get(content_type.split(";")[0].strip().lower())
+    if ext:
+        return ext
+    m = _IMG_EXT_RE.search(url)
+    if m:
+        return "." + m.group(1).lower().replace("jpeg", "jpg")
+    return ".bin"
+
+
+def _zip_entry_info(filename: str) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(filename, date_time=time.localtime(time.time())[:6])
+    if filename.lower().endswith(_PRECOMPRESSED_EXTS):
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+def _download_variant_image(
+    session: requests.Session,
+    zf: zipfile.ZipFile,
+    zip_lock: threading.Lock,
+    probe_cache: _ProbeCache,
+    k: int,
+    label_clean: str,
+    main_url: str,
+) -> Tuple[str, str]:
+    """
+    Eseguita nei thread del pool mentre il browser clicca le varianti successive:
+    probe hi-res, GET in streaming del body in un buffer del worker fuori dal lock,
+    verifica della lunghezza e solo allora copia locale nello ZIP sotto `zip_lock`
+    (ZipFile non è thread-safe): un download interrotto non lascia entry troncate.
+    Ritorna (URL scelto, errore o "").
+    """
+    best, resp, err = _fetch_best_image(session, main_url, probe_cache)
+    if resp is None:
+        return best, err
+
+    ext = _image_extension(best, resp.headers.get("Content-Type", ""))
+
+    filename = _clean_filename(f"{k:02d}_{label_clean}{ext}")
+    body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_MAX_BYTES, mode="w+b")
+    try:
+        # la rete si legge senza lock: i download dei vari worker restano paralleli
+        with resp:
+            resp.raw.decode_content = True
+            shutil.copyfileobj(resp.raw, body, length=64 * 1024)
+            # Content-Length conta i bytes sul filo: confrontabile solo senza Content-Encoding
+            expected = "" if resp.headers.get("Content-Encoding") else resp.headers.get("Content-Length", "")
+        # body troncato o vuoto: nessuna entry nello ZIP, la variante risulta fallita
+        got = body.tell()
+        if expected.isdigit() and got != int(expected):
+            return best, f"incomplete body ({got}/{expected} bytes)"
+        if got == 0:
+            return best, "empty body"
+        body.seek(0)
+        with zip_lock, zf.open(_zip_entry_info(filename), "w", force_zip64=True) as dst:
+            shutil.copyfileobj(body, dst, length=64 * 1024)
+    except Exception as e:
+        return best, type(e).__name__
+    finally:
+        body.close()
+    return best, ""
+
 
 @dataclass
 class ScrapeResult:
-    zip_bytes: bytes
+    # Archivio (out_stream del chiamante, RAM o file temporaneo), riavvolto se possibile.
+    # È l'unico accesso a memoria limitata: lo chiude chi lo ha letto.
+    zip_file: BinaryIO
     found_image_urls: List[str]
     downloaded_ok: List[str]
     downloaded_failed: List[str]
     debug: List[str]
 
+    @property
+    def zip_bytes(self) -> bytes:
+        # Comodità per chi vuole i bytes: l'archivio intero finisce in RAM, anche
+        # quando era già passato su disco oltre ZIP_SPOOL_MAX_BYTES
+        # Serve uno zip_file rileggibile: con un out_stream in sola scrittura o non
+        # riposizionabile (socket, risposta HTTP...) l'archivio è già dal chiamante
+        try:
+            self.zip_file.seek(0)
+            return self.zip_file.read()
+        except (AttributeError, OSError, io.UnsupportedOperation) as e:
+            raise ValueError(
+                f"ZIP non rileggibile da {type(self.zip_file).__name__}: usare lo stream passato come out_stream"
+            ) from e
+
 
 # -----------------------
 # Core logic
 # -----------------------
 
-def _login_via_modal(page, email: str, password: str, timeout_ms: int, debug: List[str]) -> None:
-    # Trigger: a.login.js_popupLogin
+def _block_unneeded_resources(page, debug: List[str]) -> None:
+    # Blocco dentro Chromium via CDP: nessuna richiesta passa da Python e la
+    # cache HTTP resta attiva (context.route la disattiverebbe). Va chiamata
+    # prima del goto; se CDP non è disponibile si naviga senza blocchi.
+    try:
+        cdp = page.context.new_cdp_session(page)
+        cdp.send("Network.enable")
+        cdp.send("Network.setBlockedURLs", {"urls": list(_BLOCKED_URL_PATTERNS)})
+    except Exception as e:
+        debug.append(f"WARNING: resource blocking off ({type(e).__name__})")
+
+
+def _login_via_modal(page, email: str, password: str, timeout_ms: int, debug: List[str]) -> bool:
+    # Trigger: a.login.js_popupLogin. Ritorna True se il login risulta riuscito
     debug.append("Click login trigger (popup modal)")
-    page.click("a.login.js_popupLogin", timeout=timeout_ms)
+    page.click(LOGIN_TRIGGER_SEL, timeout=timeout_ms)
 
     debug.append("Wait modal body")
     page.wait_for_selector("#js_popupSignInBody", timeout=timeout_ms)
@@ -152,8 +495,16 @@ def _login_via_modal(page, email: str, password: str, timeout_ms: int, debug: Li
     except PlaywrightTimeoutError:
         debug.append("Modal did not detach (ok if site keeps it hidden). Continue.")
 
-    # Small buffer for session cookies
-    time.sleep(1.5)
+    # A login riuscito il link di login sparisce: è il segnale che i cookie di sessione
+    # ci sono. Attesa a evento, quindi gratuita se il sito è rapido: tetto pieno
+    # timeout_ms anche per i login lenti
+    try:
+        page.wait_for_selector(LOGIN_TRIGGER_SEL, state="hidden", timeout=timeout_ms)
+        debug.append("Login trigger gone: session ready")
+        return True
+    except PlaywrightTimeoutError:
+        debug.append("Login trigger still visible. Continue.")
+        return False
 
 
 def _extract_color_swatch_map(page, timeout_ms: int, debug: List[str]):
@@ -162,57 +513,99 @@ def _extract_color_swatch_map(page, timeout_ms: int, debug: List[str]):
     <a class="js_colorswitch colorSwitch" data-color="CR" title="Classic Red (CR)">...
        <div class="color-code-thumb">CR</div>
     """
-    swatches = page.locator("a.js_colorswitch.colorSwitch")
-    n = swatches.count()
-    debug.append(f"Found swatches: {n}")
-
-    items = []
-    for i in range(n):
-        h = swatches.nth(i)
-        title = (h.get_attribute("title") or "").strip()
-        data_color = (h.get_attribute("data-color") or "").strip()
-
-        code_text = ""
-        try:
-            code_text = h.locator(
-                "xpath=ancestor::div[contains(@class,'wrapperSwitchColore')]//div[contains(@class,'color-code-thumb')]"
-            ).inner_text(timeout=300).strip()
-        except Exception:
-            pass
-
-        items.append({
-            "index": i,
-            "handle": h,
-            "title": title,
-            "data_color": data_color,
-            "code_text": code_text,
-        })
-
-    return items
-
+    # Un solo evaluate per tutte le swatch invece di 3 chiamate al browser per swatch
+    items = page.evaluate(
+        """sel => Array.from(document.querySelectorAll(sel)).map((a, i) => ({
+            index: i,
+            title: (a.getAttribute('title') || '').trim(),
+            data_color: (a.getAttribute('data-color') || '').trim(),
+            code_text: (a.closest('div[class*="wrapperSwitchColore"]')
+                ?.querySelector('div[class*="color-code-thumb"]')?.innerText || '').trim(),
+        }))""",
+        SWATCH_SEL,
+    )
+    debug.append(f"Found swatches: {len(items)}")
+
+    # Stessa variante ripetuta nel DOM (es. blocchi swatch duplicati): basta la prima.
+    # `index` resta quello nel DOM, serve per il click.
+    by_key = {}
+    for it in items:
+        by_key.setdefault((_norm(it["data_color"] or it["code_text"]), _norm(it["title"])), it)
+    unique = list(by_key.values())
+    if len(unique) != len(items):
+        debug.append(f"Unique swatches: {len(unique)}")
+
+    # niente handle: il click avviene per indice sulla tab che gestisce la variante
+    return unique
+
+
+def _resolve_wanted_swatches(swatch_items, wanted_norm: List[str], debug: List[str]):
+    """
+    Per ogni colore richiesto (nell'ORDINE dell'utente) trova la swatch.
+    L'indice si costruisce una volta: match "forte" sul codice esatto
+    (data-color / color-code-thumb) in O(1), poi titolo che contiene.
+    """
+    by_code = {}
+    for it in swatch_items:
+        for code in (_norm(it["data_color"]), _norm(it["code_text"])):
+            if code:
+                by_code.setdefault(code, it)
+    titles = [(_norm(it["title"]), it) for it in swatch_items]
+
+    ordered = []
+    for w in wanted_norm:
+        match = by_code.get(w)
+        if match is None:
+            match = next((it for t, it in titles if w in t), None)
+        if match:
+            ordered.append(match)
+        else:
+            debug.append(f"WARNING: no swatch matched '{w}'")
+    return ordered
 
-def _match_swatch(item, wanted_norm: List[str]) -> bool:
-    if not wanted_norm:
-        return True
 
-    t = _norm(item["title"])
-    dc = _norm(item["data_color"])
-    ct = _norm(item["code_text"])
+def _read_main_photo_src(page) -> str:
+    # Attributo "grezzo" (non risolto), così il confronto dopo il click è coerente
+    return page.evaluate(
+        "sel => document.querySelector(sel)?.getAttribute('src') || ''",
+        MAIN_PHOTO_SEL,
+    )
 
-    for w in wanted_norm:
-        # match “codice” esatto
-        if w and (w == dc or w == ct):
-            return True
-        # match sul titolo (contains)
-        if w and w in t:
-            return True
 
-    return False
+def _wait_main_photo_ready(page, timeout_ms: int) -> str:
+    """
+    Attende la foto principale visibile e con un src non vuoto, e lo ritorna.
+    Un src vuoto non è una base valida: il primo src comparso (foto di default)
+    verrebbe scambiato per il cambio dovuto al click.
+    """
+    page.wait_for_selector(MAIN_PHOTO_SEL, state="visible", timeout=timeout_ms)
+    page.wait_for_function(
+        "sel => !!document.querySelector(sel)?.getAttribute('src')",
+        arg=MAIN_PHOTO_SEL,
+        timeout=timeout_ms,
+    )
+    return _read_main_photo_src(page)
 
 
-def _wait_after_color_change(page, seconds: int, debug: List[str]) -> None:
-    debug.append(f"Wait after click: {seconds}s")
-    time.sleep(max(0, int(seconds)))
+def _wait_main_photo_change(page, old_src: str, seconds: int, debug: List[str]) -> None:
+    """
+    Attende che la foto principale cambi src dopo il click sulla variante.
+    `seconds` è solo il tetto massimo: di solito il sito risponde in 1-3s.
+    """
+    timeout_ms = max(0, int(seconds)) * 1000
+    if timeout_ms:
+        try:
+            page.wait_for_function(
+                """([sel, old]) => {
+                    const src = document.querySelector(sel)?.getAttribute('src') || '';
+                    return !!src && src !== old;
+                }""",
+                arg=[MAIN_PHOTO_SEL, old_src],
+                timeout=timeout_ms,
+            )
+            debug.append("Main photo src changed")
+        except PlaywrightTimeoutError:
+            debug.append(f"Main photo src unchanged after {seconds}s (same image?). Continue.")
 
 
 def _get_main_photo_url(page, product_url: str, timeout_ms: int, debug: List[str]) -> str:
@@ -220,14 +613,19 @@ def _get_main_photo_url(page, product_url: str, timeout_ms: int, debug: List[str
     Prende SOLO la foto principale nella gallery:
       #js_productMainPhoto img.callToZoom
     """
-    page.wait_for_selector("#js_productMainPhoto img.callToZoom", timeout=timeout_ms)
-    src = page.locator("#js_productMainPhoto img.callToZoom").get_attribute("src") or ""
+    page.wait_for_selector(MAIN_PHOTO_SEL, timeout=timeout_ms)
+    src = page.locator(MAIN_PHOTO_SEL).get_attribute("src") or ""
     src = src.strip()
 
     if not src:
         return ""
 
     full = urljoin(product_url, src)
+    if not _is_http_url(full):
+        # es. placeholder data:/blob: del lazy-load: non scaricabile via requests
+        debug.append(f"Main photo src not http(s): {full[:80]}")
+        return ""
+
     debug.append(f"Main photo src: {full}")
     return full
 
@@ -240,6 +638,9 @@ def scrape_images_with_login_sync(
     wait_after_click_seconds: int = 15,
     headless: bool = True,
     timeout_ms: int = 45000,
+    parallel_pages: int = 3,
+    download_workers: int = DOWNLOAD_WORKERS,
+    out_stream: Optional[BinaryIO] = None,
 ) -> ScrapeResult:
     debug: List[str] = []
 
@@ -265,54 +666,55 @@ def scrape_images_with_login_sync(
                 "--single-process",
             ],
         )
-        context = browser.new_context()
+        # Se c'è una sessione recente per queste credenziali, si riparte dai suoi cookie
+        state_path = _login_state_path(email, password)
+        cached_state = _fresh_login_state(state_path)
+        try:
+            context = browser.new_context(storage_state=cached_state)
+        except Exception as e:
+            debug.append(f"Cached session unreadable ({type(e).__name__}): fresh login")
+            cached_state = None
+            context = browser.new_context()
         page = context.new_page()
+        _block_unneeded_resources(page, debug)
 
         debug.append(f"Open product: {product_url}")
         page.goto(product_url, wait_until="domcontentloaded", timeout=timeout_ms)
 
-        _login_via_modal(page, email=email, password=password, timeout_ms=timeout_ms, debug=debug)
-
-        # Ricarica prodotto con sessione
-        debug.append("Reload product page after login")
-        page.goto(product_url, wait_until="domcontentloaded", timeout=timeout_ms)
-        time.sleep(1.0)
-
-        # Sessione requests con cookie di Playwright
-        cookies = context.cookies()
-        sess = requests.Session()
-        sess.headers.update({
-            "User-Agent": "Mozilla/5.0 (compatible; ImageDownloader/1.0)",
-            "Accept": "*/*",
-            "Referer": product_url,
-        })
-        for c in cookies:
-            sess.cookies.set(c["name"], c["value"], domain=c.get("domain"), path=c.get("path"))
+        if cached_state and not page.locator(LOGIN_TRIGGER_SEL).first.is_visible():
+            debug.append("Cached session still valid: skip login")
+        else:
+            logged_in = _login_via_modal(page, email=email, password=password, timeout_ms=timeout_ms, debug=debug)
+
+            # Il login dal popup non lascia la pagina: si ricarica solo se le swatch
+            # non sono più disponibili (cookie già impostati nel context)
+            if page.locator(SWATCH_SEL).first.is_visible():
+                debug.append("Swatches visible after login: no reload")
+            else:
+                debug.append("Reload product page after login")
+                page.reload(wait_until="domcontentloaded", timeout=timeout_ms)
+                page.wait_for_selector(MAIN_PHOTO_SEL, state="visible", timeout=timeout_ms)
+
+            # si salva solo una sessione confermata: con il link di login ancora
+            # visibile i cookie potrebbero non essere quelli autenticati
+            if not logged_in:
+                debug.append("Login not confirmed: session not saved")
+            else:
+                try:
+                    _save_login_state(context, state_path)
+                    debug.append("Session saved for next runs")
+                except Exception as e:
+                    debug.append(f"WARNING: session not saved ({type(e).__name__})")
 
         # Legge swatch e decide cosa cliccare
         swatch_items = _extract_color_swatch_map(page, timeout_ms=timeout_ms, debug=debug)
 
         # Se l’utente ha lista colori, clicchiamo nell’ORDINE dell’utente.
-        # Per farlo, per ogni wanted cerchiamo la prima swatch che matcha.
-        ordered_to_click = []
         if wanted_norm:
-            for w in wanted_norm:
-                match = None
-                for it in swatch_items:
-                    # match "forte": codice esatto o titolo contiene
-                    t = _norm(it["title"])
-                    dc = _norm(it["data_color"])
-                    ct = _norm(it["code_text"])
-                    if w == dc or w == ct or (w in t):
-                        match = it
-                        break
-                if match:
-                    ordered_to_click.append(match)
-                else:
-                    debug.append(f"WARNING: no swatch matched '{w}'")
+            ordered_to_click = _resolve_wanted_swatches(swatch_items, wanted_norm, debug)
         else:
             # Se non specifichi lista, clicca tutte le swatch trovate (non consigliato, ma utile)
-            ordered_to_click = [it for it in swatch_items if _match_swatch(it, wanted_norm)]
+            ordered_to_click = list(swatch_items)
 
         debug.append(f"Swatches selected for clicking: {len(ordered_to_click)}")
 
@@ -320,66 +722,120 @@ def scrape_images_with_login_sync(
         downloaded_ok: List[str] = []
         downloaded_failed: List[str] = []
 
-        # ZIP in memoria
-        mem = io.BytesIO()
-        with zipfile.ZipFile(mem, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            for k, it in enumerate(ordered_to_click, start=1):
-                title = it["title"]
-                data_color = it["data_color"]
-                code_text = it["code_text"]
-
-                label = code_text or data_color or title or f"color_{k}"
-                label_clean = _clean_filename(label)
-
-                debug.append(f"[{k}] Click swatch: title='{title}' data-color='{data_color}' code='{code_text}'")
-
-                # click e attesa lunga (come richiesto)
-                try:
-                    it["handle"].click(timeout=timeout_ms)
-                except Exception as e:
-                    downloaded_failed.append(f"{label} (click failed: {type(e).__name__})")
-                    debug.append(f"[{k}] ERROR click: {type(e).__name__}: {e}")
-                    continue
-
-                _wait_after_color_change(page, wait_after_click_seconds, debug)
-
-                # prendi SOLO immagine principale (gallery)
-                main_url = _get_main_photo_url(page, product_url=product_url, timeout_ms=timeout_ms, debug=debug)
-                if not main_url:
-                    downloaded_failed.append(f"{label} (main image not found)")
-                    continue
+        # Più tab sullo stesso context (cookie di login condivisi): si clicca una
+        # variante per tab e poi si attende il cambio foto su ciascuna, così le
+        # attese dei vari colori si sovrappongono invece di sommarsi.
+        # Le tab extra partono con wait_until="commit": caricano in parallelo tra
+        # loro e mentre si prepara la sessione requests qui sotto.
+        extras = []
+        n_pages = max(1, min(int(parallel_pages), len(ordered_to_click)))
+        for _ in range(n_pages - 1):
+            extra = context.new_page()
+            _block_unneeded_resources(extra, debug)
+            extra.goto(product_url, wait_until="commit", timeout=timeout_ms)
+            extras.append(extra)
 
-                found_urls.append(main_url)
-
-                # prova a prendere versione hi-res
-                cands = _best_image_url_candidates(main_url)
-                best = _pick_best_existing_url(sess, cands)
+        # Sessione requests con cookie di Playwright
+        sess = _build_download_session(product_url, context.cookies(), download_workers)
+
+        # swatch presenti non bastano: i click vanno dopo domcontentloaded,
+        # quando gli handler JS delle varianti sono già agganciati
+        for extra in extras:
+            extra.wait_for_load_state("domcontentloaded", timeout=timeout_ms)
+            extra.wait_for_selector(SWATCH_SEL, timeout=timeout_ms)
+        pages = [page] + extras
+        debug.append(f"Pages used for clicking: {len(pages)}")
+
+        # Foto principale pronta su ogni tab prima del primo click (anche la pagina
+        # principale: con sessione in cache o senza reload nessuno l'ha attesa)
+        for pg in pages:
+            _wait_main_photo_ready(pg, timeout_ms)
+
+        # ZIP scritto dai thread del pool: ogni download parte appena la foto è nota
+        # e scorre mentre il browser clicca le varianti successive.
+        # Va in `out_stream` se il chiamante lo fornisce (file, risposta HTTP...),
+        # altrimenti in RAM fino a ZIP_SPOOL_MAX_BYTES e oltre su file temporaneo.
+        # Compressione decisa per entry (_zip_entry_info): STORED per le immagini.
+        if out_stream is not None:
+            mem = out_stream
+        else:
+            mem = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_BYTES, mode="w+b")
+        zip_lock = threading.Lock()
+        probe_cache = _ProbeCache()
+        futures = {}
+        seen_urls = set()
+        with zipfile.ZipFile(mem, "w", compression=zipfile.ZIP_STORED, strict_timestamps=False) as zf, \
+                ThreadPoolExecutor(max_workers=max(1, int(download_workers))) as ex:
+            numbered = list(enumerate(ordered_to_click, start=1))
+            for start in range(0, len(numbered), len(pages)):
+                clicked = []
+                for pg, (k, it) in zip(pages, numbered[start:start + len(pages)]):
+                    title = it["title"]
+                    data_color = it["data_color"]
+                    code_text = it["code_text"]
+
+                    label = code_text or data_color or title or f"color_{k}"
+                    label_clean = _clean_filename(label)
+
+                    debug.append(f"[{k}] Click swatch: title='{title}' data-color='{data_color}' code='{code_text}'")
+
+                    # click subito su tutte le tab del giro, l'attesa viene dopo
+                    old_src = _read_main_photo_src(pg)
+                    try:
+                        if not old_src:
+                            old_src = _wait_main_photo_ready(pg, timeout_ms)
+                        pg.locator(SWATCH_SEL).nth(it["index"]).click(timeout=timeout_ms)
+                    except Exception as e:
+                        downloaded_failed.append(f"{label} (click failed: {type(e).__name__})")
+                        debug.append(f"[{k}] ERROR click: {type(e).__name__}: {e}")
+                        continue
+                    clicked.append((pg, k, label, label_clean, old_src))
+
+                for pg, k, label, label_clean, old_src in clicked:
+                    # attesa del cambio foto (wait_after_click_seconds = tetto massimo)
+                    _wait_main_photo_change(pg, old_src, wait_after_click_seconds, debug)
+
+                    # prendi SOLO immagine principale (gallery)
+                    main_url = _get_main_photo_url(pg, product_url=product_url, timeout_ms=timeout_ms, debug=debug)
+                    if not main_url:
+                        downloaded_failed.append(f"{label} (main image not found)")
+                        continue
+
+                    # varianti che ricadono sulla stessa foto (es. immagine di default)
+                    if main_url in seen_urls:
+                        debug.append(f"[{k}] Skip duplicate image: {main_url}")
+                        continue
+                    seen_urls.add(main_url)
+
+                    found_urls.append(main_url)
+                    fut = ex.submit(
+                        _download_variant_image, sess, zf, zip_lock, probe_cache, k, label_clean, main_url
+                    )
+                    futures[fut] = k
+
+            browser.close()
+
+            # Esiti raccolti nell'ordine delle varianti (i download restano paralleli):
+            # debug e liste ok/fallite non dipendono da quale GET finisce prima
+            for fut, k in futures.items():
+                best, err = fut.result()
                 debug.append(f"[{k}] Best candidate: {best}")
-
-                img_bytes, err = _download_bytes(sess, best)
-                if not img_bytes:
+                if err:
                     downloaded_failed.append(f"{best} ({err})")
-                    continue
-
-                # estensione
-                ext = ".jpg"
-                m = re.search(r"\.(jpg|jpeg|png|webp|gif)(\?|$)", best, re.I)
-                if m:
-                    ext = "." + m.group(1).lower().replace("jpeg", "jpg")
-
-                filename = _clean_filename(f"{k:02d}_{label_clean}{ext}")
-                zf.writestr(filename, img_bytes)
-                downloaded_ok.append(best)
+                else:
+                    downloaded_ok.append(best)
 
+    # Riavvolto se possibile: SpooledTemporaryFile ha seekable() solo da Python 3.11,
+    # e un out_stream del chiamante può non supportare seek
+    try:
         mem.seek(0)
-        zip_bytes = mem.getvalue()
-
-        browser.close()
-
-        return ScrapeResult(
-            zip_bytes=zip_bytes,
-            found_image_urls=found_urls,
-            downloaded_ok=downloaded_ok,
-            downloaded_failed=downloaded_failed,
-            debug=debug,
-        )
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+
+    return ScrapeResult(
+        zip_file=mem,
+        found_image_urls=found_urls,
+        downloaded_ok=downloaded_ok,
+        downloaded_failed=downloaded_failed,
+        debug=debug,
+    )